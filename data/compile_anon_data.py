@@ -22,6 +22,10 @@ Exported Files (each of these dictionaries is parameterized by semester):
    to a set of sections, representing an estimated course registration for that semester.
    This data approximates the course selections that each student might have made during
    the registration period.
+
+If COMPRESS_EXPORTS is set below, each file is instead written zstd-compressed with a '.zst'
+suffix (e.g. 'watching.pkl.zst'), and loading it requires the `zstandard` package:
+`pickle.load(zstandard.ZstdDecompressor().stream_reader(file))`.
 """
 
 
@@ -29,61 +33,143 @@ import os
 import pickle
 import random
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 
-from django.db.models import F, OuterRef, Q, Subquery
+from django.db import connection
+from django.db.models import CharField, Exists, F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Concat
 
 from alert.models import Registration  # Penn Course Alert subscription
 from alert.models import AddDropPeriod
-from courses.models import Course, NGSSRestriction, PreNGSSRestriction, Section
+from courses.models import Meeting, NGSSRestriction, PreNGSSRestriction, Section
 from PennCourses.settings.base import FIRST_BANNER_SEM
 from plan.models import Schedule  # Penn Course Plan schedule
 
 
-all_section_info = dict()
-all_watching = dict()
-all_est_registration = dict()
+DATA_DIR = os.path.expanduser("~/git/course-trading/data")
 
-for semester in ["2020C", "2021A", "2021C", "2022A", "2022C", "2023A", "2023C"]:
-    adp = AddDropPeriod.objects.get(semester=semester)
-    snapshot_date = adp.estimated_end - timedelta(days=1)
+# Set to True to zstd-compress the exports (written as *.pkl.zst, requires the `zstandard`
+# package). Off by default since the notebook loads the exports with a plain pickle.load.
+COMPRESS_EXPORTS = False
 
-    # Get a map from primary course id (integer) -> full code (e.g. CIS-120)
-    primary_course_full_codes = dict(
-        Course.objects.filter(semester=semester, primary_listing_id=F("id")).values_list(
-            "id", "full_code"
-        )
+# Number of rows to fetch at a time when streaming large querysets
+CHUNK_SIZE = 5000
+
+# Map from section activity code (e.g. "LEC") -> display string (e.g. "Lecture")
+ACTIVITY_MAP = dict(Section.ACTIVITY_CHOICES)
+
+SEMESTERS = ["2020C", "2021A", "2021C", "2022A", "2022C", "2023A", "2023C"]
+
+
+def export_pickle(obj, filename):
+    """
+    Pickle obj to DATA_DIR/filename (or filename + ".zst", zstd-compressed, when
+    COMPRESS_EXPORTS is set), using the fastest available protocol and a 1 MiB write buffer.
+    """
+    path = os.path.join(DATA_DIR, filename)
+    if COMPRESS_EXPORTS:
+        import zstandard as zstd
+
+        with open(path + ".zst", "wb", buffering=1 << 20) as raw, zstd.ZstdCompressor(
+            level=3, threads=-1
+        ).stream_writer(raw) as file:
+            pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+        return
+    with open(path, "wb", buffering=1 << 20) as file:
+        pickle.dump(obj, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def primary_full_code(section_prefix):
+    """
+    Returns an expression for the full code of a section under its course's primary listing
+    (e.g. CIS-120-001), given the lookup prefix from the queried model to the section.
+    """
+    return Concat(
+        f"{section_prefix}course__primary_listing__full_code",
+        Value("-"),
+        f"{section_prefix}code",
+        output_field=CharField(),
     )
 
+
+def compile_semester(semester):
+    """
+    Returns (section_info, watching, est_registration) for the given semester,
+    in the format described at the top of this file.
+    """
+    try:
+        return _compile_semester(semester)
+    finally:
+        # Each worker thread opens its own DB connection; don't leak it
+        connection.close()
+
+
+def _compile_semester(semester):
+    adp = AddDropPeriod.objects.get(semester=semester)
+    snapshot_date = adp.estimated_end - timedelta(days=1)
+
     # Section registration restriction, used to determine if permit is required
     Restriction = NGSSRestriction if semester >= FIRST_BANNER_SEM else PreNGSSRestriction
-    permit_required_ids = set(Restriction.special_approval().values_list("sections__id", flat=True))
 
-    section_info = {
-        s.full_code: {
-            "activity": dict(Section.ACTIVITY_CHOICES)[s.activity],
-            "meetings": [
-                {
-                    "day": m.day,
-                    "start": m.start,  # hh:mm is formatted as hh.mm = h+mm/100
-                    "end": m.end,  # hh:mm is formatted as hh.mm = h+mm/100
-                }
-                for m in s.meetings.all()
-            ],
-            "enrollment": s.enrollment,
-            "capacity": s.capacity,
-            "open": s.status == "O",
-            "permit_required": s.id in permit_required_ids,
-        }
-        for s in Section.objects.filter(
+    sections = (
+        Section.objects.filter(
             ~Q(status="X"),
             ~Q(activity=""),
             course__semester=semester,
             course__primary_listing_id=F("course_id"),  # exclude crosslistings
         )
+        .annotate(
+            permit_required=Exists(
+                Restriction.special_approval().filter(sections__id=OuterRef("id"))
+            )
+        )
+        .values_list(
+            "id", "full_code", "activity", "enrollment", "capacity", "status", "permit_required"
+        )
+    )
+
+    # Group meetings by section id in one pass, rather than loading Meeting objects per section
+    meetings_by_section_id = defaultdict(list)
+    for section_id, day, start, end in (
+        Meeting.objects.filter(section__in=Subquery(sections.values("id")))
+        .values_list("section_id", "day", "start", "end")
+        .iterator(chunk_size=CHUNK_SIZE)
+    ):
+        meetings_by_section_id[section_id].append(
+            {
+                "day": day,
+                "start": start,  # hh:mm is formatted as hh.mm = h+mm/100
+                "end": end,  # hh:mm is formatted as hh.mm = h+mm/100
+            }
+        )
+
+    section_info = {
+        full_code: {
+            "activity": ACTIVITY_MAP[activity],
+            "meetings": meetings_by_section_id[section_id],
+            "enrollment": enrollment,
+            "capacity": capacity,
+            "open": status == "O",
+            "permit_required": permit_required,
+        }
+        for (
+            section_id,
+            full_code,
+            activity,
+            enrollment,
+            capacity,
+            status,
+            permit_required,
+        ) in sections.iterator(chunk_size=CHUNK_SIZE)
     }
 
-    valid_sections = set(section_info.keys())
+    # Map each valid section code to the key object in section_info, so that watching and
+    # est_registration share one string per section (pickle then writes each code once per file
+    # and refers back to it, rather than re-serializing it for every student)
+    section_codes = {code: code for code in section_info}
 
     # Get active Penn Course Alert subscriptions for each student in this semester
     active_subscriptions = (
@@ -94,15 +180,17 @@ for semester in ["2020C", "2021A", "2021C", "2022A", "2022C", "2023A", "2023C"]:
             created_at__lte=snapshot_date,
             section__course__semester=semester,
         )
-        .values_list("user_id", "section__code", "section__course__primary_listing_id")
-        .order_by("original_created_at")
+        .annotate(full_code=primary_full_code("section__"))
+        .values_list("user_id", "full_code")
+        .order_by("user_id", "original_created_at")
     )
     watching = defaultdict(list)
-    for user_id, code, primary_listing_id in active_subscriptions:
-        full_code = primary_course_full_codes[primary_listing_id] + f"-{code}"
-        if full_code not in valid_sections:
-            continue
-        watching[user_id].append(full_code)
+    for user_id, rows in groupby(
+        active_subscriptions.iterator(chunk_size=CHUNK_SIZE), key=itemgetter(0)
+    ):
+        watched = [section_codes[full_code] for _, full_code in rows if full_code in section_codes]
+        if watched:
+            watching[user_id] = watched
 
     # Get the most recently updated Penn Course Plan schedule for each student in this semester
     latest_schedules = (
@@ -115,37 +203,65 @@ for semester in ["2020C", "2021A", "2021C", "2022A", "2022C", "2023A", "2023C"]:
             )
         )
         .filter(updated_at=F("max_updated_at"))
-        .prefetch_related("sections", "sections__course")
+    )
+    # Flat (schedule id, student id, section full code) rows for all latest schedules
+    schedule_sections = (
+        Schedule.sections.through.objects.filter(
+            schedule_id__in=Subquery(latest_schedules.values("id"))
+        )
+        .annotate(user_id=F("schedule__person_id"), full_code=primary_full_code("section__"))
+        .order_by("schedule_id")
+        .values_list("schedule_id", "user_id", "full_code")
     )
 
     # Get map from student to their estimated registration in this semester
     # (defined as their latest-updated Penn Course Plan schedule,
     #  minus sections watched on Penn Course Alert)
-    est_registration = {}
-    for schedule in latest_schedules:
-        user_id = schedule.person_id
-        sections = {
-            primary_course_full_codes[s.course.primary_listing_id] + f"-{s.code}"
-            for s in schedule.sections.all()
+    est_registration = {
+        user_id: set() for user_id in latest_schedules.values_list("person_id", flat=True)
+    }
+    for (_, user_id), rows in groupby(
+        schedule_sections.iterator(chunk_size=CHUNK_SIZE), key=itemgetter(0, 1)
+    ):
+        est_registration[user_id] = {
+            section_codes[full_code] for _, _, full_code in rows if full_code in section_codes
         }
-        sections &= valid_sections
-        est_registration[user_id] = sections - set(watching[user_id])
+    for user_id, sections in est_registration.items():
+        # Indexing the defaultdict also gives every student with a schedule a watching entry,
+        # which the notebook relies on
+        sections.difference_update(watching[user_id])
 
     # Anonymize user IDs by shuffling and taking index in list as new ID
-    student_ids = list(set(watching.keys()) | set(est_registration.keys()))
+    # (re-keying the entries in a single pass, without building a separate old -> new ID map)
+    student_ids = list(watching.keys() | est_registration.keys())
     random.shuffle(student_ids)
-    anon_num = {old_id: i for i, old_id in enumerate(student_ids)}
-    watching = {anon_num[user_id]: v for user_id, v in watching.items()}
-    est_registration = {anon_num[user_id]: v for user_id, v in est_registration.items()}
+    anon_watching = {}
+    anon_est_registration = {}
+    for anon_id, user_id in enumerate(student_ids):
+        if user_id in watching:
+            anon_watching[anon_id] = watching.pop(user_id)
+        if user_id in est_registration:
+            anon_est_registration[anon_id] = est_registration.pop(user_id)
+
+    return section_info, anon_watching, anon_est_registration
+
+
+all_section_info = dict()
+all_watching = dict()
+all_est_registration = dict()
 
-    all_section_info[semester] = section_info
-    all_watching[semester] = watching
-    all_est_registration[semester] = est_registration
+# Semesters are independent and mostly bound on DB round-trips, so compile them concurrently
+with ThreadPoolExecutor(max_workers=len(SEMESTERS)) as executor:
+    for semester, (section_info, watching, est_registration) in zip(
+        SEMESTERS, executor.map(compile_semester, SEMESTERS)
+    ):
+        all_section_info[semester] = section_info
+        all_watching[semester] = watching
+        all_est_registration[semester] = est_registration
 
 # Export watching[semester] (map from anon student # ->
 #   list of watched sections at the end of this semester, in chronological order of watching initiation)
-with open(os.path.expanduser("~/git/course-trading/data/watching.pkl"), "wb") as file:
-    pickle.dump(all_watching, file)
+export_pickle(all_watching, "watching.pkl")
 
 # Export section_info[semester] (map from section full_code ->
 #   {activity: string, enrollment: int, capacity: int, open: bool, permit_required: bool,
@@ -154,10 +270,8 @@ with open(os.path.expanduser("~/git/course-trading/data/watching.pkl"), "wb") as
 #                end: float,     # hh:mm is formatted as hh.mm = hh+mm/100
 #               }
 #   })
-with open(os.path.expanduser("~/git/course-trading/data/section_info.pkl"), "wb") as file:
-    pickle.dump(all_section_info, file)
+export_pickle(all_section_info, "section_info.pkl")
 
 # Export est_registration[semester] (map from anon student # ->
 #   set of sections estimated to be their Path registration for this semester)
-with open(os.path.expanduser("~/git/course-trading/data/estimated-registration.pkl"), "wb") as file:
-    pickle.dump(all_est_registration, file)
+export_pickle(all_est_registration, "estimated-registration.pkl")